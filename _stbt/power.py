@@ -1,10 +1,14 @@
 from __future__ import annotations
 
+import asyncio
+import configparser
 import enum
 import errno
+import functools
 import json
 import re
 import subprocess
+import threading
 import time
 import typing
 
@@ -13,29 +17,36 @@ from _stbt.types import PDU
 
 if typing.TYPE_CHECKING:
     # pylint: disable=unused-import
-    import configparser
     import pysnmp.hlapi
     SnmpAuth: typing.TypeAlias = (
         pysnmp.hlapi.CommunityData | pysnmp.hlapi.UsmUserData)
     # pylint: enable=unused-import
 
 
+# One alternative per PDU type.  The outer group of each alternative names the
+# PDU type (a key of `_URI_FACTORIES`) and its sub-groups are named
+# "<type>__<argument>":
+_URI_REGEX = re.compile(r"""
+    (?P<none>none)
+    | (?P<file>file:(?P<file__filename>[^:]+))
+    | (?P<aten>aten:(?P<aten__address>[^: ]+):(?P<aten__outlet>[^: ]+))
+    | (?P<rittal>rittal:(?P<rittal__address>[^: ]+):(?P<rittal__outlet>[^: ]+)
+                 :(?P<rittal__community>[^: ]+))
+    | (?P<aviosys>aviosys-8800-pro(:(?P<aviosys__filename>[^:]+))?)
+    | (?P<kasa>kasa:(?P<kasa__hostname>[^:]+))
+    """, re.VERBOSE | re.IGNORECASE)
+
+
 def uri_to_power_outlet(uri: str) -> PDU:
-    remotes = [
-        (r'none', _NoOutlet),
-        (r'file:(?P<filename>[^:]+)', _FileOutlet),
-        (r'aten:(?P<address>[^: ]+):(?P<outlet>[^: ]+)',
-         _ATEN_PE6108G.from_uri_groups),
-        (r'rittal:(?P<address>[^: ]+):(?P<outlet>[^: ]+)'
-         ':(?P<community>[^: ]+)', _RittalSnmpPower.from_uri_groups),
-        (r'aviosys-8800-pro(:(?P<filename>[^:]+))?', _new_aviosys_8800_pro),
-        (r'kasa:(?P<hostname>[^:]+)', Kasa),
-    ]
-    for regex, factory in remotes:
-        m = re.match(regex, uri, re.VERBOSE | re.IGNORECASE)
-        if m:
-            return factory(**m.groupdict())
-    raise ConfigurationError('Invalid power outlet URI: "%s"' % uri)
+    m = _URI_REGEX.fullmatch(uri)
+    if not m:
+        raise ConfigurationError('Invalid power outlet URI: "%s"' % uri)
+    # The outer group of the matching alternative is the last to close:
+    name = m.lastgroup
+    prefix = name + "__"
+    return _URI_FACTORIES[name](**{
+        k[len(prefix):]: v for k, v in m.groupdict().items()
+        if k.startswith(prefix)})
 
 
 def config_to_power_outlet(
@@ -78,37 +89,68 @@ def config_to_power_outlet(
             pduname = config["device_under_test"]["power_outlet"]
         except KeyError:
             return _NoOutlet()
+    section_name = "power_outlet %s" % pduname
+    try:
+        section = config[section_name]
+    except KeyError:
+        section = None
+
+    # Constructing a PDU can be expensive (importing pysnmp, resolving
+    # addresses, opening serial ports) so we reuse PDUs with the same config.
+    # The key uses the raw values so we only interpolate the values that the
+    # PDU actually reads, as we did before there was a cache.
+    if section is None:
+        key = (pduname, None)
+    elif isinstance(config, configparser.RawConfigParser):
+        key = (pduname, tuple(sorted(config.items(section_name, raw=True))))
+    else:
+        key = (pduname, tuple(sorted(section.items())))
+
+    with _PDU_CACHE_LOCK:
+        try:
+            return _PDU_CACHE[key]
+        except KeyError:
+            key_lock = _PDU_CACHE_KEY_LOCKS.setdefault(key, threading.Lock())
+
+    # Constructing a PDU isn't necessarily idempotent (e.g. it may open a
+    # serial port) so we never construct the same PDU twice concurrently, but
+    # a slow PDU doesn't block other threads from getting unrelated PDUs.
+    with key_lock:
+        with _PDU_CACHE_LOCK:
+            try:
+                return _PDU_CACHE[key]
+            except KeyError:
+                pass
+        pdu = _new_power_outlet(pduname, section)
+        with _PDU_CACHE_LOCK:
+            _PDU_CACHE[key] = pdu
+        return pdu
+
+
+_PDU_CACHE: "dict[tuple, PDU]" = {}
+_PDU_CACHE_KEY_LOCKS: "dict[tuple, threading.Lock]" = {}
+_PDU_CACHE_LOCK = threading.Lock()
+
+
+def _new_power_outlet(
+        pduname: str, section: "typing.Mapping[str, str] | None") -> PDU:
     try:
         # For backwards compatibility with old config files
         return uri_to_power_outlet(pduname)
     except ConfigurationError:
         pass
-    try:
-        section = config["power_outlet %s" % pduname]
-    except KeyError:
+    if section is None:
         raise ConfigurationError(
             "Expected to find section [power_outlet %s] in config file because "
             "device_under_test.power_outlet == %r.  No such section found" %
             (pduname, pduname))
     try:
         ty = section["type"].lower()
-        if ty == "none":
-            return _NoOutlet()
-        elif ty == "file":
-            return _FileOutlet(section["filename"])
-        elif ty == "aten":
-            return _ATEN_PE6108G.from_config_section(section)
-        elif ty == "apc":
-            return _APC7xxx.from_config_section(section)
-        elif ty == "rittal":
-            return _RittalSnmpPower.from_config_section(section)
-        elif ty == "aviosys-8800-pro":
-            return _new_aviosys_8800_pro(section.get("filename"))
-        elif ty == "kasa":
-            return Kasa(section["address"])
-        else:
+        factory = _CONFIG_FACTORIES.get(ty)
+        if factory is None:
             raise ConfigurationError(
                 '%s: Unknown power outlet type: "%s"' % (pduname, ty))
+        return factory(section)
     except KeyError as e:
         raise ConfigurationError(
             'Failed to find key "%s" in section [power_outlet %s] in config '
@@ -234,25 +276,32 @@ class _FakeAviosys8800ProSerial():
     def __init__(self):
         self.is_on = False
         self.remainder = ""
-        self.outbuf = ""
-        self.inbuf = ""
+        self.outbuf = bytearray()
+        self.inbuf = bytearray()
 
     def readline(self):
-        idx = self.outbuf.find('\n')
+        idx = self.outbuf.find(b'\n')
         assert idx >= 0, "FakeUsbPower8000 would have blocked"
 
-        out, self.outbuf = self.outbuf[:idx + 1], self.outbuf[idx + 1:]
-        return out
+        out = bytes(self.outbuf[:idx + 1])
+        del self.outbuf[:idx + 1]
+        return out.decode()
 
     def respond(self, text):
-        self.outbuf += text
+        self.outbuf.extend(text.encode())
 
     def write(self, data):
-        self.inbuf += data
-
-        while '\n' in self.inbuf:
-            idx = self.inbuf.find('\n')
-            line, self.inbuf = self.inbuf[:idx], self.inbuf[idx + 1:]
+        # Only search the newly written data for newlines:
+        start = len(self.inbuf)
+        self.inbuf.extend(data.encode() if isinstance(data, str) else data)
+
+        while True:
+            idx = self.inbuf.find(b'\n', start)
+            if idx < 0:
+                break
+            line = bytes(self.inbuf[:idx]).decode()
+            del self.inbuf[:idx + 1]
+            start = 0
 
             if len(line) >= 4 and line[:3] == "p1=":
                 if line[3] == '0':
@@ -327,11 +376,17 @@ class _ATEN_PE6108G(PDU):
     def set(self, power):
         new_state = self._snmp.set(2 if power else 1)
 
-        # ATEN PE6108G outlets take between 4-8 seconds to power on
-        for _ in range(12):
-            time.sleep(1)
+        # ATEN PE6108G outlets take between 4-8 seconds to power on.  Poll
+        # more often at first so we return quickly if it's faster than that,
+        # but give up after waiting 12 seconds in total.
+        waited = 0.
+        delay = 0.1
+        while waited < 12:
+            time.sleep(delay)
+            waited += delay
             if self._snmp.get() == new_state:
                 return
+            delay = min(delay * 2, 1., 12 - waited)
         raise RuntimeError(
             "Timeout waiting for outlet to power {}".format(
                 "ON" if power else "OFF"))
@@ -464,15 +519,23 @@ def _snmp_config(
 
         auth = hlapi.UsmUserData(userName=get("username"), **kwargs)
     elif version == "2c":
-        auth = hlapi.CommunityData(get("community"), mpModel=1)
+        auth = _community_data(get("community"), mp_model=1)
     elif version == "1":
-        auth = hlapi.CommunityData(get("community"), mpModel=0)
+        auth = _community_data(get("community"), mp_model=0)
     else:
         raise ValueError("Invalid SNMP version %s" % version)
 
     return ((address, port), auth)
 
 
+@functools.lru_cache(maxsize=16)
+def _community_data(community: str, mp_model: int):
+    """PDUs typically share a community string, so share the auth objects too.
+    """
+    from pysnmp import hlapi
+    return hlapi.CommunityData(community, mpModel=mp_model)
+
+
 def test_snmp_config():
     import pytest
     from pysnmp import hlapi
@@ -538,11 +601,42 @@ def test_snmp_config():
     assert c.privProtocol == hlapi.usmAesCfb128Protocol
 
 
+_COMMAND_GENERATORS: "dict[tuple | None, tuple[typing.Any, threading.Lock]]" = {}  # pylint: disable=line-too-long
+_COMMAND_GENERATORS_LOCK = threading.Lock()
+
+
+def _get_command_generator(
+        auth: "SnmpAuth") -> "tuple[typing.Any, threading.Lock]":
+    """Creating a CommandGenerator initialises a whole SNMP engine, so we share
+    them between the PDUs in this process.  Returns the CommandGenerator and a
+    lock that must be held while using it.  PDUs using different engines can
+    make requests concurrently.
+
+    An engine only remembers one set of SNMPv3 keys per username, so PDUs using
+    SNMPv3 only share an engine if their credentials are identical.  All
+    v1/v2c PDUs share one engine because communities are configured by name.
+    """
+    from pysnmp import hlapi
+    if isinstance(auth, hlapi.UsmUserData):
+        key = (auth.userName, auth.authProtocol, auth.authKey,
+               auth.privProtocol, auth.privKey)
+    else:
+        key = None
+    with _COMMAND_GENERATORS_LOCK:
+        try:
+            return _COMMAND_GENERATORS[key]
+        except KeyError:
+            from pysnmp.entity.rfc3413.oneliner import cmdgen
+            out = (cmdgen.CommandGenerator(), threading.Lock())
+            _COMMAND_GENERATORS[key] = out
+            return out
+
+
 class _SnmpInteger():
     def __init__(self, address: "tuple[str, int]", oid: str, auth: "SnmpAuth"):
-        from pysnmp.entity.rfc3413.oneliner.cmdgen import UdpTransportTarget
+        from pysnmp.entity.rfc3413.oneliner import cmdgen
         self.oid = oid
-        self._transport = UdpTransportTarget(address)
+        self._transport = cmdgen.UdpTransportTarget(address)
         self._auth = auth
 
     def set(self, value: int) -> int:
@@ -552,18 +646,18 @@ class _SnmpInteger():
         return self._cmd(None)
 
     def _cmd(self, value: "int | None") -> int:
-        from pysnmp.entity.rfc3413.oneliner import cmdgen
         from pysnmp.proto.rfc1905 import NoSuchObject
         from pysnmp.proto.rfc1902 import Integer
 
-        command_generator = cmdgen.CommandGenerator()
+        command_generator, lock = _get_command_generator(self._auth)
 
-        if value is None:  # `status` command
-            error_ind, _, _, var_binds = command_generator.getCmd(
-                self._auth, self._transport, self.oid)
-        else:
-            error_ind, _, _, var_binds = command_generator.setCmd(
-                self._auth, self._transport, (self.oid, Integer(value)))
+        with lock:
+            if value is None:  # `status` command
+                error_ind, _, _, var_binds = command_generator.getCmd(
+                    self._auth, self._transport, self.oid)
+            else:
+                error_ind, _, _, var_binds = command_generator.setCmd(
+                    self._auth, self._transport, (self.oid, Integer(value)))
 
         if error_ind is not None:
             raise RuntimeError("SNMP Error ({})".format(error_ind))
@@ -580,24 +674,85 @@ class _SnmpInteger():
 
 
 class Kasa(PDU):
-    """TP-Link Kasa smart plugs."""
+    """TP-Link Kasa smart plugs.
+
+    Talks to the plug in-process with python-kasa if it's installed, falling
+    back to the `kasa` CLI otherwise.
+    """
 
     def __init__(self, hostname):
         self.hostname = hostname
+        self._plug = _new_kasa_plug(hostname)
 
     def set(self, power):
+        if self._plug is not None:
+            _run_kasa(
+                self._plug.turn_on() if power else self._plug.turn_off())
+            return
         # `kasa` CLI from python-kasa.
         subprocess.check_call(
             ["kasa", "--host", self.hostname, "--type", "plug",
              "on" if power else "off"])
 
     def get(self):
+        if self._plug is not None:
+            _run_kasa(self._plug.update())
+            return bool(self._plug.is_on)
         json_data = subprocess.check_output(
             ["kasa", "--host", self.hostname, "--type", "plug", "--json",
              "state"])
         return _kasa_output_to_state(json.loads(json_data))
 
 
+def _new_kasa_plug(hostname):
+    try:
+        from kasa.iot import IotPlug
+    except ImportError:
+        try:
+            # python-kasa < 0.6
+            from kasa import SmartPlug as IotPlug
+        except ImportError:
+            return None
+    return IotPlug(hostname)
+
+
+_KASA_LOOP = None
+_KASA_LOOP_LOCK = threading.Lock()
+
+
+def _run_kasa(coro):
+    """Run a python-kasa coroutine to completion.  We use the same event loop
+    every time so the plug can reuse its connection."""
+    global _KASA_LOOP
+    with _KASA_LOOP_LOCK:
+        if _KASA_LOOP is None:
+            _KASA_LOOP = asyncio.new_event_loop()
+        return _KASA_LOOP.run_until_complete(coro)
+
+
+# Defined down here because they refer to the PDU classes above:
+
+_URI_FACTORIES = {
+    "none": _NoOutlet,
+    "file": _FileOutlet,
+    "aten": _ATEN_PE6108G.from_uri_groups,
+    "rittal": _RittalSnmpPower.from_uri_groups,
+    "aviosys": _new_aviosys_8800_pro,
+    "kasa": Kasa,
+}
+
+# Keyed by the `type` in the config section.  Each factory takes the section:
+_CONFIG_FACTORIES = {
+    "none": lambda _: _NoOutlet(),
+    "file": lambda s: _FileOutlet(s["filename"]),
+    "aten": _ATEN_PE6108G.from_config_section,
+    "apc": _APC7xxx.from_config_section,
+    "rittal": _RittalSnmpPower.from_config_section,
+    "aviosys-8800-pro": lambda s: _new_aviosys_8800_pro(s.get("filename")),
+    "kasa": lambda s: Kasa(s["address"]),
+}
+
+
 def _kasa_output_to_state(json_data):
     return bool(json_data["system"]["get_sysinfo"]["relay_state"])
 
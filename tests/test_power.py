@@ -1,13 +1,18 @@
 """Tests for the _ATEN_PE6108G PDU class"""
 
 import configparser
+import threading
 from contextlib import contextmanager
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import pytest
 from pysnmp.proto.rfc1902 import Integer
 
-from _stbt.power import config_to_power_outlet
+from _stbt.config import ConfigurationError
+from _stbt.power import (
+    _COMMAND_GENERATORS, _FileOutlet, _get_command_generator, _NoOutlet,
+    _PDU_CACHE, _SnmpInteger, config_to_power_outlet, Kasa,
+    uri_to_power_outlet)
 
 CONFIG_INI = """
 [device_under_test]
@@ -24,6 +29,13 @@ CONFIG = configparser.ConfigParser()
 CONFIG.read_string(CONFIG_INI)
 
 
+@pytest.fixture(autouse=True)
+def clear_pdu_cache():
+    _PDU_CACHE.clear()
+    yield
+    _PDU_CACHE.clear()
+
+
 def mock_data(int_value):
     """Match the format of the data returned from pysnmp"""
     return (None, None, None, [(oid, Integer(int_value))])
@@ -31,12 +43,14 @@ def mock_data(int_value):
 
 @contextmanager
 def mock_command_gen():
-    """Perform mocks and return a mocked CommandGenerator instance."""
-    with patch('time.sleep'),\
+    """Perform mocks and return a mocked CommandGenerator instance and the
+    mocked `time.sleep`."""
+    with patch('time.sleep') as mocked_sleep,\
             patch('pysnmp.entity.rfc3413.oneliner.cmdgen.UdpTransportTarget'),\
-            patch('pysnmp.entity.rfc3413.oneliner.cmdgen.CommandGenerator')\
-            as mocked_command_gen:
-        yield mocked_command_gen.return_value
+            patch('_stbt.power._get_command_generator',
+                  return_value=(MagicMock(), threading.Lock()))\
+            as mocked_get_command_gen:
+        yield mocked_get_command_gen.return_value[0], mocked_sleep
 
 
 outlet = 1
@@ -44,7 +58,7 @@ oid = "1.3.6.1.4.1.21317.1.3.2.2.2.2.{0}.0".format(outlet + 1)
 
 
 def test_aten_get_on():
-    with mock_command_gen() as mock_command:
+    with mock_command_gen() as (mock_command, _):
         mock_command.getCmd.return_value = mock_data(2)
         aten = config_to_power_outlet(config=CONFIG)
 
@@ -54,7 +68,7 @@ def test_aten_get_on():
 
 
 def test_aten_get_off():
-    with mock_command_gen() as mock_command:
+    with mock_command_gen() as (mock_command, _):
         mock_command.getCmd.return_value = mock_data(1)
         aten = config_to_power_outlet(config=CONFIG)
 
@@ -64,7 +78,7 @@ def test_aten_get_off():
 
 
 def test_aten_set_on():
-    with mock_command_gen() as mock_command:
+    with mock_command_gen() as (mock_command, _):
         mock_command.setCmd.return_value = mock_data(2)
         mock_command.getCmd.side_effect = [mock_data(n) for n in (1, 1, 1, 2)]
         aten = config_to_power_outlet(config=CONFIG)
@@ -75,7 +89,7 @@ def test_aten_set_on():
 
 
 def test_aten_set_off():
-    with mock_command_gen() as mock_command:
+    with mock_command_gen() as (mock_command, _):
         mock_command.setCmd.return_value = mock_data(1)
         mock_command.getCmd.side_effect = [mock_data(n) for n in (2, 2, 1)]
         aten = config_to_power_outlet(config=CONFIG)
@@ -86,7 +100,7 @@ def test_aten_set_off():
 
 
 def test_aten_set_timeout():
-    with mock_command_gen() as mock_command:
+    with mock_command_gen() as (mock_command, mock_sleep):
         mock_command.setCmd.return_value = mock_data(1)
         mock_command.getCmd.return_value = mock_data(2)
         aten = config_to_power_outlet(config=CONFIG)
@@ -94,6 +108,12 @@ def test_aten_set_timeout():
         with pytest.raises(RuntimeError):
             aten.set(False)
 
+        # Backs off from 0.1s to polling once a second, giving up after 12s:
+        sleeps = [c.args[0] for c in mock_sleep.call_args_list]
+        assert sleeps[:5] == pytest.approx([0.1, 0.2, 0.4, 0.8, 1.])
+        assert sum(sleeps) == pytest.approx(12)
+        assert mock_command.getCmd.call_count == len(sleeps)
+
 
 def test_nooutlet():
     p = configparser.ConfigParser()
@@ -107,3 +127,282 @@ def test_nooutlet():
 
     with pytest.raises(Exception):
         pdu.power_off()
+
+
+def test_uri_to_power_outlet():
+    assert isinstance(uri_to_power_outlet("none"), _NoOutlet)
+    f = uri_to_power_outlet("file:/tmp/outlet")
+    assert isinstance(f, _FileOutlet)
+    assert f.filename == "/tmp/outlet"
+    k = uri_to_power_outlet("kasa:192.168.1.5")
+    assert isinstance(k, Kasa)
+    assert k.hostname == "192.168.1.5"
+
+    # The whole URI must match, not just a prefix:
+    for uri in ["nonesuch", "file:/tmp/outlet:junk", "myoutlet"]:
+        with pytest.raises(ConfigurationError):
+            uri_to_power_outlet(uri)
+
+
+def test_config_to_power_outlet_is_cached():
+    config = {
+        "power_outlet a": {"type": "file", "filename": "/tmp/a"},
+        "power_outlet b": {"type": "file", "filename": "/tmp/b"},
+    }
+    a = config_to_power_outlet("a", config)
+    assert config_to_power_outlet("a", config) is a
+    assert config_to_power_outlet("b", config) is not a
+
+    # A change to the config section gives a new PDU:
+    config["power_outlet a"]["filename"] = "/tmp/c"
+    c = config_to_power_outlet("a", config)
+    assert c is not a
+    assert c.filename == "/tmp/c"
+
+
+def test_config_to_power_outlet_doesnt_block_on_slow_pdu():
+    from _stbt import power
+
+    config = {
+        "power_outlet slow": {"type": "file", "filename": "/tmp/slow"},
+        "power_outlet fast": {"type": "file", "filename": "/tmp/fast"},
+    }
+    started = threading.Event()
+    release = threading.Event()
+    new_power_outlet = power._new_power_outlet
+
+    def slow_new_power_outlet(pduname, section):
+        if pduname == "slow":
+            started.set()
+            assert release.wait(10)
+        return new_power_outlet(pduname, section)
+
+    with patch("_stbt.power._new_power_outlet", slow_new_power_outlet):
+        t = threading.Thread(
+            target=config_to_power_outlet, args=("slow", config))
+        t.start()
+        try:
+            assert started.wait(10)
+            # Doesn't wait for the "slow" PDU to be constructed:
+            assert config_to_power_outlet("fast", config).filename == \
+                "/tmp/fast"
+        finally:
+            release.set()
+            t.join()
+    assert config_to_power_outlet("slow", config).filename == "/tmp/slow"
+
+
+def test_config_to_power_outlet_only_interpolates_values_it_uses():
+    config = configparser.ConfigParser()
+    config.read_string("""
+        [power_outlet myoutlet]
+        type = file
+        filename = /tmp/outlet
+        note = 100% fake
+        """)
+    pdu = config_to_power_outlet("myoutlet", config)
+    assert isinstance(pdu, _FileOutlet)
+    assert config_to_power_outlet("myoutlet", config) is pdu
+
+    # URIs work even if there's a section with the same name:
+    config.read_string("""
+        [power_outlet none]
+        note = 100% fake
+        """)
+    assert isinstance(config_to_power_outlet("none", config), _NoOutlet)
+
+
+def test_config_to_power_outlet_constructs_each_pdu_once():
+    from _stbt import power
+
+    config = {"power_outlet a": {"type": "file", "filename": "/tmp/a"}}
+    started = threading.Event()
+    release = threading.Event()
+    constructed = []
+    new_power_outlet = power._new_power_outlet
+
+    def slow_new_power_outlet(pduname, section):
+        constructed.append(pduname)
+        started.set()
+        assert release.wait(10)
+        return new_power_outlet(pduname, section)
+
+    results = []
+    with patch("_stbt.power._new_power_outlet", slow_new_power_outlet):
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    config_to_power_outlet("a", config)))
+            for _ in range(2)]
+        for t in threads:
+            t.start()
+        assert started.wait(10)
+        release.set()
+        for t in threads:
+            t.join()
+
+    assert constructed == ["a"]
+    assert len(results) == 2
+    assert results[0] is results[1]
+
+
+def test_snmp_command_generators_are_shared():
+    config = {
+        "power_outlet apc": {
+            "type": "apc", "address": "127.0.0.1", "outlet": "1",
+            "username": "admin", "auth_passphrase": "apc-passw0rd"},
+        "power_outlet aten": {
+            "type": "aten", "address": "127.0.0.1", "outlet": "1",
+            "username": "admin", "auth_passphrase": "aten-passw0rd"},
+        "power_outlet aten2": {
+            "type": "aten", "address": "127.0.0.1", "outlet": "2",
+            "username": "admin", "auth_passphrase": "aten-passw0rd"},
+        "power_outlet rittal1": {
+            "type": "rittal", "address": "127.0.0.1", "outlet": "1",
+            "community": "public"},
+        "power_outlet rittal2": {
+            "type": "rittal", "address": "127.0.0.1", "outlet": "2",
+            "community": "public"},
+        "power_outlet rittal3": {
+            "type": "rittal", "address": "127.0.0.1", "outlet": "3",
+            "community": "private"},
+    }
+
+    def auth(name):
+        return config_to_power_outlet(name, config)._snmp._auth
+
+    with patch.dict(_COMMAND_GENERATORS, clear=True):
+        # SNMPv3 PDUs with the same username but different keys mustn't share
+        # an engine, or the second PDU's keys would be ignored:
+        assert (_get_command_generator(auth("apc")) is not
+                _get_command_generator(auth("aten")))
+        assert (_get_command_generator(auth("aten")) is
+                _get_command_generator(auth("aten2")))
+
+        # The same community string gives the same auth object:
+        assert auth("rittal1") is auth("rittal2")
+        assert auth("rittal1") is not auth("rittal3")
+        # And all community-based PDUs share an engine:
+        assert (_get_command_generator(auth("rittal1")) is
+                _get_command_generator(auth("rittal3")))
+        assert (_get_command_generator(auth("rittal1")) is not
+                _get_command_generator(auth("apc")))
+
+
+def test_snmp_requests_on_different_engines_run_concurrently():
+    from pysnmp import hlapi
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def new_command_generator():
+        command_generator = MagicMock()
+        command_generator.getCmd.return_value = mock_data(1)
+        return command_generator
+
+    slow = _SnmpInteger(
+        ("127.0.0.1", 161), oid, hlapi.UsmUserData("admin", "slow-passw0rd"))
+    fast = _SnmpInteger(
+        ("127.0.0.1", 161), oid, hlapi.UsmUserData("admin", "fast-passw0rd"))
+
+    with patch.dict(_COMMAND_GENERATORS, clear=True), \
+            patch('pysnmp.entity.rfc3413.oneliner.cmdgen.CommandGenerator',
+                  side_effect=new_command_generator):
+        slow_command_generator, _ = _get_command_generator(slow._auth)
+
+        def slow_get(*_):
+            started.set()
+            assert release.wait(10)
+            return mock_data(1)
+        slow_command_generator.getCmd.side_effect = slow_get
+
+        slow_thread = threading.Thread(target=slow.get)
+        slow_thread.start()
+        try:
+            assert started.wait(10)
+            # Doesn't wait for the request to the "slow" PDU to finish:
+            fast_thread = threading.Thread(target=fast.get)
+            fast_thread.start()
+            fast_thread.join(10)
+            assert not fast_thread.is_alive()
+        finally:
+            release.set()
+            slow_thread.join()
+
+
+class FakeKasaPlug():
+    def __init__(self, relay_state):
+        self.calls = []
+        self._relay_state = relay_state
+        self._is_on = None
+
+    async def update(self):
+        self.calls.append("update")
+        self._is_on = self._relay_state
+
+    async def turn_on(self):
+        self.calls.append("turn_on")
+        self._relay_state = True
+
+    async def turn_off(self):
+        self.calls.append("turn_off")
+        self._relay_state = False
+
+    @property
+    def is_on(self):
+        assert self._is_on is not None, "is_on read before update()"
+        return self._is_on
+
+
+def test_kasa():
+    plug = FakeKasaPlug(relay_state=False)
+    with patch("_stbt.power._new_kasa_plug", return_value=plug):
+        kasa = Kasa("192.168.1.5")
+
+    assert kasa.get() is False
+    assert plug.calls == ["update"]
+
+    kasa.set(True)
+    assert plug.calls == ["update", "turn_on"]
+    assert kasa.get() is True
+
+    kasa.set(False)
+    assert plug.calls == ["update", "turn_on", "update", "turn_off"]
+    assert kasa.get() is False
+
+
+def test_kasa_cli_fallback():
+    with patch("_stbt.power._new_kasa_plug", return_value=None):
+        kasa = Kasa("192.168.1.5")
+
+    with patch("subprocess.check_call") as check_call:
+        kasa.set(True)
+        check_call.assert_called_once_with(
+            ["kasa", "--host", "192.168.1.5", "--type", "plug", "on"])
+
+    with patch("subprocess.check_output",
+               return_value=b'{"system": {"get_sysinfo": {"relay_state": 0}}}'
+               ) as check_output:
+        assert kasa.get() is False
+        check_output.assert_called_once_with(
+            ["kasa", "--host", "192.168.1.5", "--type", "plug", "--json",
+             "state"])
+
+
+def test_config_to_power_outlet_errors():
+    with pytest.raises(ConfigurationError, match="Unknown power outlet type"):
+        config_to_power_outlet(
+            "myoutlet", {"power_outlet myoutlet": {"type": "bogus"}})
+
+    with pytest.raises(ConfigurationError,
+                       match=r'Failed to find key "filename" in section '
+                             r'\[power_outlet myoutlet\]'):
+        config_to_power_outlet(
+            "myoutlet", {"power_outlet myoutlet": {"type": "file"}})
+
+    with pytest.raises(ConfigurationError, match='Failed to find key "type"'):
+        config_to_power_outlet(
+            "myoutlet", {"power_outlet myoutlet": {"filename": "/tmp/a"}})
+
+    with pytest.raises(ConfigurationError, match="No such section found"):
+        config_to_power_outlet("myoutlet", {})